@@ -1,14 +1,17 @@
 # app.py — Render-ready Invoice Maker (Flask + SQLite + PDF + public invoice link + logo footer)
 import os
-import json
 import secrets
+import shutil
 import sqlite3
+import tempfile
 import re
-from datetime import datetime, date, timedelta
-from io import BytesIO
-from functools import wraps
+import time
+from datetime import datetime, date, timedelta, timezone
+from functools import wraps, lru_cache
+from urllib.parse import quote
 
-from flask import Flask, request, redirect, session, url_for, send_file, Response
+from flask import Flask, request, redirect, session, url_for, send_file, Response, g
+from markupsafe import escape
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from reportlab.lib.pagesizes import letter
@@ -24,33 +27,65 @@ APP_SECRET = os.getenv("APP_SECRET", "CHANGE_THIS_TO_A_LONG_RANDOM_SECRET")
 DB_FILE = os.getenv("DB_FILE", "app.db")
 
 OWNER_SETUP_KEY = os.getenv("OWNER_SETUP_KEY", "CHANGE-ME-SETUP-KEY")
+
+# Login cost is dominated by password hashing. Any werkzeug method string works,
+# e.g. "scrypt:16384:8:1" or "pbkdf2:sha256:600000". Old hashes keep verifying
+# (the method is stored inside each hash) and are re-hashed with this one on the
+# user's next successful login.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
 COMPANY_WEBSITE = "https://cargomonterrey.com/"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOGO_FILE = os.path.join(BASE_DIR, "cargo_logo.png")  # must exist in repo
 
+# Rendered PDFs are cached here (invoices never change). Losing it on redeploy is fine.
+# File names contain view tokens, so they go in a private (0700, owned by us) subdirectory.
+# Made absolute once so the existence check, the write and send_file all agree.
+PDF_CACHE_DIR = os.path.abspath(os.getenv("PDF_CACHE_DIR", os.path.join(BASE_DIR, "pdf_cache")))
+
 # ---------------- APP ----------------
 app = Flask(__name__)
 app.secret_key = APP_SECRET
 
 # ---------------- DATABASE ----------------
 def db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+    """)
     return conn
 
+def get_db():
+    """One connection per request (app context), closed in close_db."""
+    if "db" not in g:
+        g.db = db()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(e=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.close()
+
 def init_db():
     conn = db()
     cur = conn.cursor()
 
+    # Every lookup is by username, so it is the clustered key. id stays for sessions/FKs
+    # but is assigned on insert (WITHOUT ROWID tables have no AUTOINCREMENT).
+    # DBs created before this keep their rowid users table; both layouts work.
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
+        username TEXT PRIMARY KEY NOT NULL,
+        id INTEGER UNIQUE NOT NULL,
         password_hash TEXT NOT NULL,
         role TEXT NOT NULL DEFAULT 'owner',
         created_at TEXT NOT NULL
-    )
+    ) WITHOUT ROWID
     """)
 
     cur.execute("""
@@ -74,20 +109,48 @@ def init_db():
     )
     """)
 
+    # (invoice_id, seq) is the clustered key, so lookups by invoice_id need no extra index.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS invoice_items (
+        invoice_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        description TEXT NOT NULL DEFAULT '',
+        qty REAL NOT NULL DEFAULT 1,
+        unit_price REAL NOT NULL DEFAULT 0,
+        line_total REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY(invoice_id, seq),
+        FOREIGN KEY(invoice_id) REFERENCES invoices(id)
+    ) WITHOUT ROWID
+    """)
+
     conn.commit()
     conn.close()
 
 def migrate_db():
-    """Adds missing columns safely (won't break existing DB)."""
+    """Adds missing columns safely (won't break existing DB). Returns (invoice_cols, user_cols)."""
     conn = db()
     cur = conn.cursor()
 
-    cur.execute("PRAGMA table_info(invoices)")
-    cols = [r[1] for r in cur.fetchall()]
+    # One pass over every table's columns instead of a PRAGMA per table.
+    schema = {}
+    cur.execute("""
+        SELECT m.name, p.name
+        FROM sqlite_master m JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table'
+    """)
+    for table, col in cur.fetchall():
+        schema.setdefault(table, set()).add(col)
+    cols = schema["invoices"]
+    ucols = schema["users"]
+    icols = schema["invoice_items"]
+    changed = False
 
     def add_col(name, ddl):
+        nonlocal changed
         if name not in cols:
             cur.execute(f"ALTER TABLE invoices ADD COLUMN {ddl}")
+            cols.add(name)
+            changed = True
 
     add_col("client_email", "client_email TEXT")
     add_col("client_address", "client_address TEXT")
@@ -100,43 +163,170 @@ def migrate_db():
     add_col("view_token", "view_token TEXT")
     add_col("created_at", "created_at TEXT NOT NULL DEFAULT ''")
 
-    cur.execute("PRAGMA table_info(users)")
-    ucols = [r[1] for r in cur.fetchall()]
     if "role" not in ucols:
         cur.execute("ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT 'owner'")
+        ucols.add("role")
+        changed = True
     if "created_at" not in ucols:
         cur.execute("ALTER TABLE users ADD COLUMN created_at TEXT NOT NULL DEFAULT ''")
+        ucols.add("created_at")
+        changed = True
+
+    if "line_total" not in icols:
+        cur.execute("ALTER TABLE invoice_items ADD COLUMN line_total REAL NOT NULL DEFAULT 0")
+        cur.execute("UPDATE invoice_items SET line_total = qty * unit_price")
+        changed = True
+
+    # Older DBs got view_token via ALTER (no UNIQUE), so enforce the lookup index here.
+    # id is the rowid and users.username is UNIQUE, so those are already indexed.
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_view_token ON invoices(view_token)")
+
+    # One-time data fixes; user_version records which ran, so later boots don't rescan invoices.
+    data_version = cur.execute("PRAGMA user_version").fetchone()[0]
+
+    # Invoices from before invoice_items kept their lines in items_json; copy them over once.
+    if data_version < 1:
+        cur.execute("""
+            INSERT INTO invoice_items (invoice_id, seq, description, qty, unit_price, line_total)
+            SELECT invoice_id, seq, description, qty, unit_price, qty * unit_price
+            FROM (
+                SELECT i.id AS invoice_id, j.key AS seq,
+                       COALESCE(json_extract(j.value, '$.desc'), '') AS description,
+                       COALESCE(json_extract(j.value, '$.qty'), 1) AS qty,
+                       COALESCE(json_extract(j.value, '$.unit_price'), 0) AS unit_price
+                FROM invoices i, json_each(i.items_json) j
+                WHERE i.items_json <> '[]'
+                  AND json_valid(i.items_json)
+                  AND NOT EXISTS (SELECT 1 FROM invoice_items x WHERE x.invoice_id = i.id)
+            )
+        """)
+        changed = changed or cur.rowcount > 0
+
+    # Invoices from before the total_amount column got its DEFAULT 0; PDFs print the stored
+    # total, so fill it in from their lines.
+    if data_version < 2:
+        cur.execute("""
+            UPDATE invoices
+            SET total_amount = (SELECT SUM(line_total) FROM invoice_items WHERE invoice_id = invoices.id)
+            WHERE total_amount = 0
+              AND EXISTS (SELECT 1 FROM invoice_items WHERE invoice_id = invoices.id AND line_total <> 0)
+        """)
+        changed = changed or cur.rowcount > 0
+        cur.execute("PRAGMA user_version = 2")
+
+    # Full ANALYZE only when there are no stats yet or this run changed something;
+    # otherwise every worker would re-scan every table (under a write lock) on each boot.
+    if changed or "sqlite_stat1" not in schema:
+        cur.execute("ANALYZE")
 
     conn.commit()
     conn.close()
+    return frozenset(cols), frozenset(ucols)
 
 def any_owner_exists():
-    conn = db()
-    row = conn.execute("SELECT 1 FROM users WHERE role='owner' LIMIT 1").fetchone()
-    conn.close()
+    conn = get_db()
+    row = conn.execute(_SQL_OWNER_EXISTS).fetchone()
     return bool(row)
 
-def invoices_table_has_column(col_name: str) -> bool:
-    conn = db()
-    rows = conn.execute("PRAGMA table_info(invoices)").fetchall()
-    conn.close()
-    return any(r["name"] == col_name for r in rows)
-
 init_db()
-migrate_db()
+INVOICE_COLS, USER_COLS = migrate_db()
 
 # If you previously had an old schema with invoices.user_id NOT NULL, this keeps it compatible.
-HAS_USER_ID_COL = invoices_table_has_column("user_id")
+HAS_USER_ID_COL = "user_id" in INVOICE_COLS
+
+# ---------------- SQL ----------------
+# Every statement a route runs lives here, so each one is a fixed parametric string
+# that SQLite's per-connection statement cache can reuse.
+_SQL_OWNER_EXISTS = "SELECT 1 FROM users WHERE role='owner' LIMIT 1"
+_SQL_INSERT_OWNER = """
+    INSERT INTO users (id, username, password_hash, role, created_at)
+    VALUES ((SELECT COALESCE(MAX(id), 0) + 1 FROM users), ?, ?, 'owner', ?)
+"""
+_SQL_GET_USER_BY_USERNAME = "SELECT id, password_hash, role FROM users WHERE username=? LIMIT 1"
+_SQL_UPDATE_PASSWORD_HASH = "UPDATE users SET password_hash=? WHERE username=?"
+
+# Display fields are formatted by SQLite so the dashboard loop does no per-row conversion.
+_SQL_LIST_INVOICES = """
+    SELECT id, invoice_number, client_name,
+           COALESCE(client_email, '') AS client_email,
+           COALESCE(currency, 'USD') AS currency,
+           printf('%.2f', COALESCE(total_amount, 0)) AS total_str,
+           view_token
+    FROM invoices
+    ORDER BY id DESC
+    LIMIT 250
+"""
+_SQL_GET_INVOICE_SUMMARY_BY_ID = """
+    SELECT id, invoice_number, client_name, client_email, currency, total_amount, view_token
+    FROM invoices
+    WHERE id=?
+"""
+_SQL_GET_INVOICE_PUBLIC_BY_TOKEN = """
+    SELECT invoice_number, client_name, currency, total_amount, issue_date, due_date, payment_methods, created_at
+    FROM invoices
+    WHERE view_token=?
+"""
+_SQL_GET_INVOICE_PDF_BY_ID = """
+    SELECT id, invoice_number, client_name, client_email, client_address,
+           issue_date, due_date, currency, total_amount, view_token
+    FROM invoices
+    WHERE id=?
+"""
+_SQL_GET_INVOICE_PDF_BY_TOKEN = """
+    SELECT id, invoice_number, client_name, client_email, client_address,
+           issue_date, due_date, currency, total_amount, view_token, created_at
+    FROM invoices
+    WHERE view_token=?
+"""
+
+_SQL_INSERT_INVOICE_ITEM = """
+    INSERT INTO invoice_items (invoice_id, seq, description, qty, unit_price, line_total)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_SQL_GET_INVOICE_ITEMS = "SELECT description, line_total FROM invoice_items WHERE invoice_id=? ORDER BY seq"
+
+# Built once here so new_invoice doesn't branch on the schema per request.
+_SQL_INSERT_INVOICE_WITH_USER = """
+    INSERT INTO invoices (
+      user_id,
+      invoice_number, client_name, client_email, client_address,
+      issue_date, due_date, currency,
+      payment_methods, notes, total_amount,
+      created_by_user_id, view_token, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    RETURNING id
+"""
+_SQL_INSERT_INVOICE_NO_USER = """
+    INSERT INTO invoices (
+      invoice_number, client_name, client_email, client_address,
+      issue_date, due_date, currency,
+      payment_methods, notes, total_amount,
+      created_by_user_id, view_token, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    RETURNING id
+"""
+_SQL_INSERT_INVOICE = _SQL_INSERT_INVOICE_WITH_USER if HAS_USER_ID_COL else _SQL_INSERT_INVOICE_NO_USER
 
 # ---------------- SAFE ROW GET ----------------
 def row_get(row, key, default=""):
-    try:
-        val = row[key]
-        return default if val is None else val
-    except Exception:
+    # Invoice columns are known after migrate_db, so no try/except per lookup.
+    if key not in INVOICE_COLS:
         return default
+    val = row[key]
+    return default if val is None else val
+
+# ---------------- TIME ----------------
+def utc_now_iso():
+    """UTC timestamp for created_at columns (seconds precision, ISO 8601 like before)."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
 
 # ---------------- AUTH ----------------
+# Checked against when the username doesn't exist, so a miss costs the same as a wrong password.
+# Stored hashes are moved to this same method on login (see below), which keeps the two equal.
+_DUMMY_HASH = generate_password_hash(secrets.token_urlsafe(16), method=PASSWORD_HASH_METHOD, salt_length=16)
+# Fully expanded method (e.g. "scrypt:32768:8:1"); stored hashes with another prefix get upgraded on login.
+_HASH_METHOD_PREFIX = _DUMMY_HASH.split("$", 1)[0]
+
 def staff_required(fn):
     @wraps(fn)
     def w(*a, **k):
@@ -148,6 +338,9 @@ def staff_required(fn):
     return w
 
 # ---------------- ITEMS PARSER (type anything) ----------------
+_NUM_RE = re.compile(r"[-+]?\$?\s*\d[\d,]*\.?\d*")
+_CUR_STRIP = str.maketrans("", "", "$, ")
+
 def parse_items(raw: str):
     """
     One item per line, any format.
@@ -165,12 +358,12 @@ def parse_items(raw: str):
         if not line:
             continue
 
-        nums = re.findall(r"[-+]?\$?\s*\d[\d,]*\.?\d*", line)
+        nums = _NUM_RE.findall(line)
         unit_price = 0.0
 
         if nums:
             last = nums[-1]
-            cleaned = last.replace("$", "").replace(",", "").strip()
+            cleaned = last.translate(_CUR_STRIP)
             try:
                 unit_price = float(cleaned)
             except ValueError:
@@ -190,12 +383,24 @@ def parse_items(raw: str):
     return items
 
 # ---------------- PDF ----------------
+_LOGO = None
+
+def _get_logo():
+    """Decode the footer logo once; False marks a missing/broken file so we don't retry."""
+    global _LOGO
+    if _LOGO is None:
+        try:
+            _LOGO = ImageReader(LOGO_FILE)
+        except Exception:
+            _LOGO = False
+    return _LOGO or None
+
 def invoice_pdf_bytes(inv, items):
-    buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=letter)
+    # No file object: getpdfdata() hands back the finished document as bytes.
+    c = canvas.Canvas(None, pagesize=letter)
     page_w, page_h = letter
 
-    currency = row_get(inv, "currency", "USD").upper()
+    currency = (inv["currency"] or "USD").upper()
 
     def money(x):
         sym = "$" if currency == "USD" else ""
@@ -207,23 +412,23 @@ def invoice_pdf_bytes(inv, items):
 
     y -= 26
     c.setFont("Helvetica", 10)
-    c.drawString(50, y, f"Invoice #: {row_get(inv,'invoice_number')}")
+    c.drawString(50, y, f"Invoice #: {inv['invoice_number']}")
     y -= 14
-    c.drawString(50, y, f"Issue: {row_get(inv,'issue_date')}    Due: {row_get(inv,'due_date')}    Currency: {currency}")
+    c.drawString(50, y, f"Issue: {inv['issue_date']}    Due: {inv['due_date']}    Currency: {currency}")
 
     y -= 22
     c.setFont("Helvetica-Bold", 11)
     c.drawString(50, y, "Bill To:")
     y -= 14
     c.setFont("Helvetica", 10)
-    c.drawString(50, y, row_get(inv, "client_name"))
+    c.drawString(50, y, inv["client_name"])
 
-    client_email = row_get(inv, "client_email")
+    client_email = inv["client_email"]
     if client_email:
         y -= 14
         c.drawString(50, y, client_email)
 
-    client_address = row_get(inv, "client_address")
+    client_address = inv["client_address"]
     if client_address:
         for line in client_address.splitlines():
             y -= 14
@@ -238,25 +443,21 @@ def invoice_pdf_bytes(inv, items):
     y -= 16
 
     c.setFont("Helvetica", 10)
-    total = 0.0
     FOOTER_SPACE = 160
 
     for it in items:
-        line_total = float(it.get("qty", 1)) * float(it.get("unit_price", 0))
-        total += line_total
-
         if y < FOOTER_SPACE:
             c.showPage()
             y = page_h - 60
             c.setFont("Helvetica", 10)
 
-        c.drawString(50, y, str(it.get("desc", ""))[:80])
-        c.drawRightString(560, y, money(line_total))
+        c.drawString(50, y, str(it["description"])[:80])
+        c.drawRightString(560, y, money(it["line_total"]))
         y -= 14
 
     y -= 8
     c.setFont("Helvetica-Bold", 12)
-    c.drawRightString(560, y, f"TOTAL: {money(total)}")
+    c.drawRightString(560, y, f"TOTAL: {money(inv['total_amount'])}")
 
     # -------- Footer: centered logo + centered clickable website --------
     footer_y = 80
@@ -264,13 +465,14 @@ def invoice_pdf_bytes(inv, items):
     c.setStrokeColorRGB(0.75, 0.75, 0.75)
     c.line(50, footer_y + 75, page_w - 50, footer_y + 75)
 
-    try:
-        logo = ImageReader(LOGO_FILE)
-        logo_w, logo_h = 220, 65
-        logo_x = (page_w - logo_w) / 2
-        c.drawImage(logo, logo_x, footer_y, width=logo_w, height=logo_h, mask="auto")
-    except Exception:
-        pass
+    logo = _get_logo()
+    if logo:
+        try:
+            logo_w, logo_h = 220, 65
+            logo_x = (page_w - logo_w) / 2
+            c.drawImage(logo, logo_x, footer_y, width=logo_w, height=logo_h, mask="auto")
+        except Exception:
+            pass
 
     c.setFont("Helvetica-Bold", 11)
     c.setFillColorRGB(0, 0, 0)
@@ -282,9 +484,22 @@ def invoice_pdf_bytes(inv, items):
     c.linkURL(COMPANY_WEBSITE, (page_w / 2 - 150, footer_y - 30, page_w / 2 + 150, footer_y - 5), relative=0)
     c.setFillColorRGB(0, 0, 0)
 
-    c.save()
-    buf.seek(0)
-    return buf
+    return c.getpdfdata()
+
+def pdf_response(pdf, name):
+    """Send rendered PDF bytes as a download without re-wrapping them in a file object."""
+    filename = f"{name}.pdf"
+    try:
+        filename.encode("ascii")
+        names = {"filename": filename}
+    except UnicodeEncodeError:
+        names = {
+            "filename": filename.encode("ascii", "ignore").decode("ascii"),
+            "filename*": f"UTF-8''{quote(filename)}",
+        }
+    resp = Response(pdf, mimetype="application/pdf")
+    resp.headers.set("Content-Disposition", "attachment", **names)
+    return resp
 
 # ---------------- HTML ----------------
 def page(title, body):
@@ -314,21 +529,118 @@ def page(title, body):
     <body><div class="wrap">{body}</div></body></html>
     """
 
+# ---------------- PUBLIC LINK CACHING ----------------
+# Invoices never change once created, so the view token identifies the content.
+# app.py's mtime is mixed in so a deploy that changes the page/PDF layout busts caches.
+_ETAG_VERSION = str(int(os.path.getmtime(__file__)))
+
+def public_etag(token):
+    return f"{token}.{_ETAG_VERSION}"
+
+def public_cache(resp, token, created_at=""):
+    resp.set_etag(public_etag(token))
+    resp.cache_control.no_cache = None  # send_file marks its responses no-cache
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 3600
+    if created_at:
+        try:
+            resp.last_modified = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return resp
+
+def public_not_modified(token):
+    """304 for a client that already has this token's content; None otherwise. No DB access."""
+    if request.if_none_match.contains_weak(public_etag(token)):
+        return public_cache(Response(status=304), token)
+    return None
+
+def _pdf_cache_dir():
+    """<PDF_CACHE_DIR>/invoice-pdfs/<_ETAG_VERSION>, or None if the cache can't be used safely.
+
+    PDF_CACHE_DIR itself may be shared (e.g. the persistent disk holding app.db), so only
+    the invoice-pdfs subdirectory we create is ever chmod'ed or pruned.
+    """
+    root = os.path.join(PDF_CACHE_DIR, "invoice-pdfs")
+    vdir = os.path.join(root, _ETAG_VERSION)
+    try:
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        st = os.stat(root)
+        if hasattr(os, "getuid") and st.st_uid != os.getuid():
+            return None  # someone else created it; never put tokens there
+        if st.st_mode & 0o077:
+            os.chmod(root, 0o700)
+        if not os.path.isdir(vdir):
+            os.makedirs(vdir, mode=0o700, exist_ok=True)
+            # First render since a deploy: drop PDFs from older layouts. Only older
+            # versions, so workers still on the previous deploy don't fight over it.
+            for entry in os.listdir(root):
+                if entry.isdigit() and int(entry) < int(_ETAG_VERSION):
+                    shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    except OSError:
+        return None
+    return vdir
+
+def send_invoice_pdf(conn, inv):
+    """Send inv's PDF from the cache dir, rendering and storing it on the first request."""
+    name = row_get(inv, "invoice_number", "invoice")
+    token = row_get(inv, "view_token")
+    cache_dir = _pdf_cache_dir() if token else None
+    path = os.path.join(cache_dir, f"{token}.pdf") if cache_dir else None
+
+    if path and os.path.exists(path):
+        try:
+            return send_file(path, mimetype="application/pdf", as_attachment=True,
+                             download_name=f"{name}.pdf", conditional=True)
+        except OSError:
+            pass  # pruned between the check and the open; render instead
+
+    items = conn.execute(_SQL_GET_INVOICE_ITEMS, (inv["id"],)).fetchall()
+    pdf = invoice_pdf_bytes(inv, items)
+    if path:
+        try:
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, path)
+        except OSError:
+            pass  # cache is best-effort; still serve the bytes we have
+    return pdf_response(pdf, name)
+
 # ---------------- ROUTES ----------------
 @app.get("/")
 def home():
     return redirect(url_for("dashboard") if session.get("user_id") else url_for("login"))
 
+# Static pages are rendered once at import.
+_OWNER_EXISTS_HTML = page("Owner Setup", """
+      <div class="card">
+        <h2>Owner already exists</h2>
+        <p class="muted">Login normally.</p>
+        <a class="btn2" href="/login">Go to login</a>
+      </div>
+""")
+
+_OWNER_SETUP_HTML = page("Owner Setup", """
+      <div class="card">
+        <h2>Owner Setup</h2>
+        <p class="muted">One-time setup. Use an env var on Render: OWNER_SETUP_KEY</p>
+        <form method="POST">
+          <div class="row"><div><input name="setup_key" placeholder="Setup Key" required></div></div>
+          <div class="row"><div><input name="username" placeholder="Owner Username" required></div></div>
+          <div class="row">
+            <div><input type="password" name="password" placeholder="Password" required></div>
+            <div><input type="password" name="password2" placeholder="Confirm Password" required></div>
+          </div>
+          <button class="btn" type="submit">Create Owner</button>
+        </form>
+      </div>
+""")
+
 @app.route("/owner-setup", methods=["GET", "POST"])
 def owner_setup():
     if any_owner_exists():
-        return page("Owner Setup", """
-            <div class="card">
-              <h2>Owner already exists</h2>
-              <p class="muted">Login normally.</p>
-              <a class="btn2" href="/login">Go to login</a>
-            </div>
-        """)
+        return _OWNER_EXISTS_HTML
 
     if request.method == "POST":
         key = request.form.get("setup_key", "")
@@ -338,33 +650,32 @@ def owner_setup():
 
         if key != OWNER_SETUP_KEY:
             return page("Owner Setup", "<div class='card'><h3>Wrong setup key</h3></div>")
-        if len(username) < 3 or len(password) < 6 or password != password2:
-            return page("Owner Setup", "<div class='card'><h3>Bad input</h3><p class='muted'>Username ≥ 3, Password ≥ 6, passwords match.</p></div>")
+        if not 3 <= len(username) <= 64 or len(password) < 6 or password != password2:
+            return page("Owner Setup", "<div class='card'><h3>Bad input</h3><p class='muted'>Username 3–64, Password ≥ 6, passwords match.</p></div>")
 
-        conn = db()
+        conn = get_db()
         conn.execute(
-            "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, 'owner', ?)",
-            (username, generate_password_hash(password), datetime.utcnow().isoformat())
+            _SQL_INSERT_OWNER,
+            (username, generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=16), utc_now_iso())
         )
-        conn.commit()
-        conn.close()
         return redirect(url_for("login"))
 
-    return page("Owner Setup", """
+    return _OWNER_SETUP_HTML
+
+_LOGIN_HTML = page("Login", """
       <div class="card">
-        <h2>Owner Setup</h2>
-        <p class="muted">One-time setup. Use an env var on Render: OWNER_SETUP_KEY</p>
+        <h2>Sign In</h2>
+        <p class="muted">Private invoice maker (staff only)</p>
         <form method="POST">
-          <div class="row"><div><input name="setup_key" placeholder="Setup Key" required></div></div>
-          <div class="row"><div><input name="username" placeholder="Owner Username" required></div></div>
-          <div class="row">
-            <div><input type="password" name="password" placeholder="Password" required></div>
-            <div><input type="password" name="password2" placeholder="Confirm Password" required></div>
-          </div>
-          <button class="btn" type="submit">Create Owner</button>
+          <div class="row"><div><input name="username" placeholder="Username" required></div></div>
+          <div class="row"><div><input type="password" name="password" placeholder="Password" required></div></div>
+          <button class="btn" type="submit">Sign In</button>
         </form>
+        <p class="muted" style="margin-top:12px">First time? <a href="/owner-setup">/owner-setup</a></p>
       </div>
-    """)
+""")
+
+_LOGIN_INVALID_HTML = page("Login", "<div class='card'><h3>Invalid login</h3><a class='btn2' href='/login'>Try again</a></div>")
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -372,30 +683,28 @@ def login():
         u = request.form.get("username", "").strip()
         p = request.form.get("password", "")
 
-        conn = db()
-        user = conn.execute("SELECT * FROM users WHERE username=?", (u,)).fetchone()
-        conn.close()
+        # Owner setup has never accepted these, so skip the DB and the hash entirely.
+        if len(u) < 3 or len(p) < 6:
+            return _LOGIN_INVALID_HTML
+
+        conn = get_db()
+        user = conn.execute(_SQL_GET_USER_BY_USERNAME, (u,)).fetchone()
 
-        if not user or not check_password_hash(user["password_hash"], p):
-            return page("Login", "<div class='card'><h3>Invalid login</h3><a class='btn2' href='/login'>Try again</a></div>")
+        if not user:
+            check_password_hash(_DUMMY_HASH, p)
+            return _LOGIN_INVALID_HTML
+        if not check_password_hash(user["password_hash"], p):
+            return _LOGIN_INVALID_HTML
+        if user["password_hash"].split("$", 1)[0] != _HASH_METHOD_PREFIX:
+            new_hash = generate_password_hash(p, method=PASSWORD_HASH_METHOD, salt_length=16)
+            conn.execute(_SQL_UPDATE_PASSWORD_HASH, (new_hash, u))
 
         session["user_id"] = user["id"]
-        session["username"] = user["username"]
+        session["username"] = u
         session["role"] = user["role"]
         return redirect(url_for("dashboard"))
 
-    return page("Login", """
-      <div class="card">
-        <h2>Sign In</h2>
-        <p class="muted">Private invoice maker (staff only)</p>
-        <form method="POST">
-          <div class="row"><div><input name="username" placeholder="Username" required></div></div>
-          <div class="row"><div><input type="password" name="password" placeholder="Password" required></div></div>
-          <button class="btn" type="submit">Sign In</button>
-        </form>
-        <p class="muted" style="margin-top:12px">First time? <a href="/owner-setup">/owner-setup</a></p>
-      </div>
-    """)
+    return _LOGIN_HTML
 
 @app.get("/logout")
 def logout():
@@ -405,34 +714,30 @@ def logout():
 @app.get("/dashboard")
 @staff_required
 def dashboard():
-    conn = db()
-    invs = conn.execute("""
-        SELECT id, invoice_number, client_name, client_email, total_amount, currency, created_at, view_token
-        FROM invoices
-        ORDER BY id DESC
-        LIMIT 250
-    """).fetchall()
-    conn.close()
+    conn = get_db()
+    invs = conn.execute(_SQL_LIST_INVOICES).fetchall()
 
-    rows = ""
+    parts = []
+    append = parts.append
     for r in invs:
-        rows += f"""
+        append(f"""
           <tr>
-            <td>{r['invoice_number']}</td>
-            <td>{r['client_name']}</td>
-            <td>{row_get(r,'client_email')}</td>
-            <td>{row_get(r,'currency','USD')} {float(row_get(r,'total_amount',0) or 0):.2f}</td>
+            <td>{escape(r['invoice_number'])}</td>
+            <td>{escape(r['client_name'])}</td>
+            <td>{escape(r['client_email'])}</td>
+            <td>{escape(r['currency'])} {r['total_str']}</td>
             <td><a href="/invoice/{r['id']}/pdf">PDF</a></td>
             <td><a href="/view/{r['view_token']}">Link</a></td>
           </tr>
-        """
+        """)
+    rows = "".join(parts)
 
     return page("Dashboard", f"""
       <div class="card">
         <div class="row" style="justify-content:space-between;align-items:center">
           <div>
             <h2>Invoice Maker</h2>
-            <p class="muted">Logged in as <b>{session["username"]}</b> ({session["role"]})</p>
+            <p class="muted">Logged in as <b>{escape(session["username"])}</b> ({escape(session["role"])})</p>
           </div>
           <div class="row" style="justify-content:flex-end">
             <a class="btn2" href="/logout">Logout</a>
@@ -454,79 +759,18 @@ def dashboard():
       </div>
     """)
 
-@app.route("/new", methods=["GET", "POST"])
-@staff_required
-def new_invoice():
-    if request.method == "POST":
-        invoice_number = request.form.get("invoice_number", "").strip()
-        client_name = request.form.get("client_name", "").strip()
-        client_email = request.form.get("client_email", "").strip()
-        client_address = request.form.get("client_address", "").strip()
-        issue_date = request.form.get("issue_date", "").strip()
-        due_date = request.form.get("due_date", "").strip()
-        currency = (request.form.get("currency", "USD") or "USD").upper()
-        items_raw = request.form.get("items_raw", "")
-        payment_methods = request.form.get("payment_methods", "").strip()
-        notes = request.form.get("notes", "").strip()
-
-        if not invoice_number or not client_name or not issue_date or not due_date:
-            return page("Create Invoice", "<div class='card'><h3>Missing required fields</h3></div>")
+_INV_SLOT = "\x00INV\x00"
 
-        try:
-            items = parse_items(items_raw)
-        except ValueError as e:
-            return page("Create Invoice", f"<div class='card'><h3>Items error</h3><p class='muted'>{str(e)}</p></div>")
-
-        total = sum(float(i["qty"]) * float(i["unit_price"]) for i in items)
-        token = secrets.token_urlsafe(18)
-        created_at = datetime.utcnow().isoformat()
-
-        conn = db()
-        cur = conn.cursor()
-
-        if HAS_USER_ID_COL:
-            cur.execute("""
-                INSERT INTO invoices (
-                  user_id,
-                  invoice_number, client_name, client_email, client_address,
-                  issue_date, due_date, currency, items_json,
-                  payment_methods, notes, total_amount,
-                  created_by_user_id, view_token, created_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                session["user_id"],
-                invoice_number, client_name, client_email, client_address,
-                issue_date, due_date, currency, json.dumps(items),
-                payment_methods, notes, total,
-                session["user_id"], token, created_at
-            ))
-        else:
-            cur.execute("""
-                INSERT INTO invoices (
-                  invoice_number, client_name, client_email, client_address,
-                  issue_date, due_date, currency, items_json,
-                  payment_methods, notes, total_amount,
-                  created_by_user_id, view_token, created_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                invoice_number, client_name, client_email, client_address,
-                issue_date, due_date, currency, json.dumps(items),
-                payment_methods, notes, total,
-                session["user_id"], token, created_at
-            ))
-
-        invoice_id = cur.lastrowid
-        conn.commit()
-        conn.close()
-        return redirect(url_for("created", invoice_id=invoice_id))
-
-    default_inv = f"INV-{date.today().strftime('%Y%m%d')}-{str(int(datetime.utcnow().timestamp()))[-5:]}"
-    return page("Create Invoice", f"""
+@lru_cache(maxsize=4)
+def _new_invoice_form(day):
+    """Create-invoice form for date.fromordinal(day), split around the invoice number value."""
+    today = date.fromordinal(day)
+    html = page("Create Invoice", f"""
       <div class="card">
         <h2>Create Invoice</h2>
         <form method="POST">
           <div class="row">
-            <div><input name="invoice_number" value="{default_inv}" required></div>
+            <div><input name="invoice_number" value="{_INV_SLOT}" required></div>
             <div>
               <select name="currency">
                 <option>USD</option><option>CAD</option><option>EUR</option><option>GBP</option>
@@ -540,8 +784,8 @@ def new_invoice():
           </div>
 
           <div class="row">
-            <div><input name="issue_date" value="{date.today().isoformat()}" required></div>
-            <div><input name="due_date" value="{(date.today()+timedelta(days=14)).isoformat()}" required></div>
+            <div><input name="issue_date" value="{today.isoformat()}" required></div>
+            <div><input name="due_date" value="{(today+timedelta(days=14)).isoformat()}" required></div>
           </div>
 
           <div class="row">
@@ -571,13 +815,73 @@ def new_invoice():
         </form>
       </div>
     """)
+    head, _, tail = html.partition(_INV_SLOT)
+    return head, tail
+
+@app.route("/new", methods=["GET", "POST"])
+@staff_required
+def new_invoice():
+    if request.method == "POST":
+        invoice_number = request.form.get("invoice_number", "").strip()
+        client_name = request.form.get("client_name", "").strip()
+        client_email = request.form.get("client_email", "").strip()
+        client_address = request.form.get("client_address", "").strip()
+        issue_date = request.form.get("issue_date", "").strip()
+        due_date = request.form.get("due_date", "").strip()
+        currency = (request.form.get("currency", "USD") or "USD").upper()
+        items_raw = request.form.get("items_raw", "")
+        payment_methods = request.form.get("payment_methods", "").strip()
+        notes = request.form.get("notes", "").strip()
+
+        if not invoice_number or not client_name or not issue_date or not due_date:
+            return page("Create Invoice", "<div class='card'><h3>Missing required fields</h3></div>")
+
+        try:
+            items = parse_items(items_raw)
+        except ValueError as e:
+            return page("Create Invoice", f"<div class='card'><h3>Items error</h3><p class='muted'>{str(e)}</p></div>")
+
+        for it in items:
+            it["line_total"] = float(it["qty"]) * float(it["unit_price"])
+        total = sum(it["line_total"] for it in items)
+        token = secrets.token_urlsafe(18)
+        created_at = utc_now_iso()
+
+        conn = get_db()
+
+        params = (
+            invoice_number, client_name, client_email, client_address,
+            issue_date, due_date, currency,
+            payment_methods, notes, total,
+            session["user_id"], token, created_at
+        )
+        if HAS_USER_ID_COL:
+            params = (session["user_id"],) + params
+
+        # IMMEDIATE takes the write lock up front, so the transaction never has to upgrade.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            invoice_id = conn.execute(_SQL_INSERT_INVOICE, params).fetchone()[0]
+            conn.executemany(_SQL_INSERT_INVOICE_ITEM, [
+                (invoice_id, seq, it["desc"], it["qty"], it["unit_price"], it["line_total"])
+                for seq, it in enumerate(items)
+            ])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return redirect(url_for("created", invoice_id=invoice_id))
+
+    today = date.today()
+    head, tail = _new_invoice_form(today.toordinal())
+    default_inv = f"INV-{today.year}{today.month:02d}{today.day:02d}-{int(time.time()) % 100000:05d}"
+    return head + default_inv + tail
 
 @app.get("/created/<int:invoice_id>")
 @staff_required
 def created(invoice_id):
-    conn = db()
-    inv = conn.execute("SELECT * FROM invoices WHERE id=?", (invoice_id,)).fetchone()
-    conn.close()
+    conn = get_db()
+    inv = conn.execute(_SQL_GET_INVOICE_SUMMARY_BY_ID, (invoice_id,)).fetchone()
     if not inv:
         return page("Not Found", "<div class='card'><h3>Invoice not found</h3></div>")
 
@@ -589,12 +893,12 @@ def created(invoice_id):
     if row_get(inv, "client_email"):
         subject = f"Invoice {row_get(inv,'invoice_number')}"
         body = f"Here is your invoice link: {client_link}"
-        mailto = f"mailto:{row_get(inv,'client_email')}?subject={subject.replace(' ','%20')}&body={body.replace(' ','%20')}"
+        mailto = f"mailto:{quote(row_get(inv,'client_email'), safe='@')}?subject={quote(subject)}&body={quote(body)}"
 
     return page("Created", f"""
       <div class="card">
         <h2>Invoice Created ✅</h2>
-        <p class="muted"><b>{row_get(inv,'invoice_number')}</b> for {row_get(inv,'client_name')} • {row_get(inv,'currency','USD')} {float(row_get(inv,'total_amount',0) or 0):.2f}</p>
+        <p class="muted"><b>{escape(row_get(inv,'invoice_number'))}</b> for {escape(row_get(inv,'client_name'))} • {escape(row_get(inv,'currency','USD'))} {float(row_get(inv,'total_amount',0) or 0):.2f}</p>
 
         <div class="row">
           <div><a class="btn" href="/invoice/{inv['id']}/pdf">Download PDF</a></div>
@@ -604,8 +908,8 @@ def created(invoice_id):
 
         <div class="card" style="margin-top:14px">
           <h3>Client Link</h3>
-          <p class="muted">{client_link}</p>
-          {f"<p><a class='btn2' href='{mailto}'>Email Link</a></p>" if mailto else "<p class='muted'>No client email added (optional).</p>"}
+          <p class="muted">{escape(client_link)}</p>
+          {f"<p><a class='btn2' href='{escape(mailto)}'>Email Link</a></p>" if mailto else "<p class='muted'>No client email added (optional).</p>"}
         </div>
       </div>
     """)
@@ -613,35 +917,34 @@ def created(invoice_id):
 @app.get("/invoice/<int:invoice_id>/pdf")
 @staff_required
 def invoice_pdf(invoice_id):
-    conn = db()
-    inv = conn.execute("SELECT * FROM invoices WHERE id=?", (invoice_id,)).fetchone()
-    conn.close()
+    conn = get_db()
+    inv = conn.execute(_SQL_GET_INVOICE_PDF_BY_ID, (invoice_id,)).fetchone()
     if not inv:
         return "Not found", 404
 
-    items = json.loads(row_get(inv, "items_json", "[]") or "[]")
-    pdf_buf = invoice_pdf_bytes(inv, items)
-    return send_file(pdf_buf, mimetype="application/pdf", as_attachment=True,
-                     download_name=f"{row_get(inv,'invoice_number','invoice')}.pdf")
+    return send_invoice_pdf(conn, inv)
 
 # Public view (no login)
 @app.get("/view/<token>")
 def public_view(token):
-    conn = db()
-    inv = conn.execute("SELECT * FROM invoices WHERE view_token=?", (token,)).fetchone()
-    conn.close()
+    not_modified = public_not_modified(token)
+    if not_modified:
+        return not_modified
+
+    conn = get_db()
+    inv = conn.execute(_SQL_GET_INVOICE_PUBLIC_BY_TOKEN, (token,)).fetchone()
     if not inv:
         return "Not found", 404
 
     pm = row_get(inv, "payment_methods", "").strip()
-    pm_html = "<br>".join([line for line in pm.splitlines() if line.strip()]) if pm else "No payment methods listed."
+    pm_html = "<br>".join([escape(line) for line in pm.splitlines() if line.strip()]) if pm else "No payment methods listed."
 
-    return page("Invoice", f"""
+    html = page("Invoice", f"""
       <div class="card">
-        <h2>Invoice {row_get(inv,'invoice_number')}</h2>
-        <p class="muted"><b>Client:</b> {row_get(inv,'client_name')}</p>
-        <p class="muted"><b>Total:</b> {row_get(inv,'currency','USD')} {float(row_get(inv,'total_amount',0) or 0):.2f}</p>
-        <p class="muted"><b>Issue:</b> {row_get(inv,'issue_date')} • <b>Due:</b> {row_get(inv,'due_date')}</p>
+        <h2>Invoice {escape(row_get(inv,'invoice_number'))}</h2>
+        <p class="muted"><b>Client:</b> {escape(row_get(inv,'client_name'))}</p>
+        <p class="muted"><b>Total:</b> {escape(row_get(inv,'currency','USD'))} {float(row_get(inv,'total_amount',0) or 0):.2f}</p>
+        <p class="muted"><b>Issue:</b> {escape(row_get(inv,'issue_date'))} • <b>Due:</b> {escape(row_get(inv,'due_date'))}</p>
         <div class="card">
           <h3>Payment Methods</h3>
           <p class="muted">{pm_html}</p>
@@ -649,19 +952,20 @@ def public_view(token):
         <a class="btn" href="/view/{token}/pdf">Download PDF</a>
       </div>
     """)
+    return public_cache(Response(html), token, row_get(inv, "created_at"))
 
 @app.get("/view/<token>/pdf")
 def public_pdf(token):
-    conn = db()
-    inv = conn.execute("SELECT * FROM invoices WHERE view_token=?", (token,)).fetchone()
-    conn.close()
+    not_modified = public_not_modified(token)
+    if not_modified:
+        return not_modified
+
+    conn = get_db()
+    inv = conn.execute(_SQL_GET_INVOICE_PDF_BY_TOKEN, (token,)).fetchone()
     if not inv:
         return "Not found", 404
 
-    items = json.loads(row_get(inv, "items_json", "[]") or "[]")
-    pdf_buf = invoice_pdf_bytes(inv, items)
-    return send_file(pdf_buf, mimetype="application/pdf", as_attachment=True,
-                     download_name=f"{row_get(inv,'invoice_number','invoice')}.pdf")
+    return public_cache(send_invoice_pdf(conn, inv), token, row_get(inv, "created_at"))
 
 @app.get("/health")
 def health():